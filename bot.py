@@ -1,82 +1,64 @@
-
-
-# Initialize tables
-with closing(sqlite3.connect(DB)) as conn:
-    c = conn.cursor()
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS rooms (
-        room_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        chat_id INTEGER UNIQUE
-    )""")
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS room_users (
-        room_id INTEGER,
-        user_id INTEGER,
-        PRIMARY KEY (room_id, user_id)
-    )""")
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS games (
-        room_id INTEGER PRIMARY KEY,
-        state BLOB
-    )""")
-    conn.commit()
-
-# Room management
-def get_room_by_chat(chat_id):
-    with sqlite3.connect(DB) as conn:
-        c = conn.cursor()
-        c.execute("SELECT room_id FROM rooms WHERE chat_id=?", (chat_id,))
-        row = c.fetchone()
-        return row[0] if row else None
-
-def create_room(chat_id):
-    with sqlite3.connect(DB) as conn:
-        c = conn.cursor()
-        c.execute("INSERT OR IGNORE INTO rooms(chat_id) VALUES(?)", (chat_id,))
-        conn.commit()
-        return get_room_by_chat(chat_id)
-
-def add_user(room_id, user_id):
-    with sqlite3.connect(DB) as conn:
-        c = conn.cursor()
-        c.execute("INSERT OR IGNORE INTO room_users(room_id,user_id) VALUES(?,?)", (room_id, user_id))
-        conn.commit()
-
-def remove_room(room_id):
-    with sqlite3.connect(DB) as conn:
-        c = conn.cursor()
-        c.execute("DELETE FROM rooms WHERE room_id=?", (room_id,))
-        c.execute("DELETE FROM room_users WHERE room_id=?", (room_id,))
-        c.execute("DELETE FROM games WHERE room_id=?", (room_id,))
-        conn.commit()
-
-# Game state persistence
-def save_game(room_id, game):
-    blob = pickle.dumps(game)
-    with sqlite3.connect(DB) as conn:
-        c = conn.cursor()
-        c.execute("REPLACE INTO games(room_id,state) VALUES(?,?)", (room_id, blob))
-        conn.commit()
-
-def load_game(room_id):
-    with sqlite3.connect(DB) as conn:
-        c = conn.cursor()
-        c.execute("SELECT state FROM games WHERE room_id=?", (room_id,))
-        row = c.fetchone()
-        return pickle.loads(row[0]) if row else None
-
-
 # ─── main.py ───
+import logging
 import os
+import queue
+import threading
+import time
 from telegram.ext import Updater, CommandHandler
-from telegram import ReplyKeyboardRemove
+from telegram import ReplyKeyboardRemove, Update
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, Unauthorized
 import server, game as G
 
+logger = logging.getLogger(__name__)
+
 TOKEN = os.environ['TELEGRAM_BOT_TOKEN']
 
 updater = Updater(TOKEN, use_context=True)
 dp = updater.dispatcher
 
+# Outgoing messages go through one queue, paced to Telegram's ~30/s bot-wide
+# limit, so handlers return without waiting on the API or on 429 backoff.
+SEND_RATE = 30
+SEND_RETRIES = 5
+outbox = queue.Queue()
+
+def _send(chat_id, text):
+    # Retried in place so the chat's order holds
+    attempt = 0
+    while True:
+        try:
+            dp.bot.send_message(chat_id, text)
+            return
+        except RetryAfter as e:
+            time.sleep(e.retry_after)
+        except (Unauthorized, BadRequest) as e:
+            # e.g. a player who never opened a DM with the bot; retrying won't help
+            logger.warning('dropped message to %s: %s', chat_id, e)
+            return
+        except NetworkError as e:  # includes TimedOut
+            attempt += 1
+            if attempt >= SEND_RETRIES:
+                logger.error('gave up sending to %s after %d attempts: %s', chat_id, attempt, e)
+                return
+            time.sleep(2 ** attempt)
+        except TelegramError:
+            logger.exception('failed to send message to %s', chat_id)
+            return
+
+def _drain_outbox():
+    tat = 0.0  # token bucket in GCRA form: bursts of up to SEND_RATE messages
+    while True:
+        chat_id, text = outbox.get()
+        now = time.monotonic()
+        wait = tat - (SEND_RATE - 1) / SEND_RATE - now
+        if wait > 0:
+            time.sleep(wait)
+            now += wait
+        tat = max(tat, now) + 1 / SEND_RATE
+        _send(chat_id, text)
+
+threading.Thread(target=_drain_outbox, name='outbox', daemon=True).start()
+
 # /start - create room
 def handler_start(update, ctx):
     chat = update.effective_chat.id
@@ -90,26 +72,22 @@ def handler_join(update, ctx):
     if not room:
         return update.message.reply_text("No room. Use /start first.")
     user = update.effective_user.id
-    server.add_user(room, user)
+    server.add_user(room, user, update.effective_user.first_name)
     update.message.reply_text(f"{update.effective_user.first_name} joined room {room}.")
 
 # /begin - start game
 def handler_begin(update, ctx):
     chat = update.effective_chat.id
     room = server.get_room_by_chat(chat)
-    from server import DB
-    users = []
-    conn = __import__('sqlite3').connect(DB)
-    for row in conn.execute("SELECT user_id FROM room_users WHERE room_id=?", (room,)):
-        users.append(row[0])
-    conn.close()
+    users = server.list_users(room)  # user_id -> first name
     if len(users)<4 or len(users)>6:
         return update.message.reply_text("Need 4-6 players to begin.")
-    game = G.ParchiDhapGame(users)
+    game = G.ParchiDhapGame(list(users), users)
     server.save_game(room, game)
     # DM hands & turn
-    for pid, hand in game.hands.items():
-        ctx.bot.send_message(pid, f"Your hand: {hand}\nIt's {ctx.bot.get_chat_member(chat, game.get_current()).user.first_name}'s turn.")
+    turn = game.player_names[game.get_current()]
+    for pid in game.players:
+        outbox.put((pid, f"Your hand: {game.hand(pid)}\nIt's {turn}'s turn."))
     update.message.reply_text("Game started!")
 
 # /pass - pass a card
@@ -125,16 +103,16 @@ def handler_pass(update, ctx):
     except:
         return update.message.reply_text("Usage: /pass <card_value>")
     try:
-        hand, winner = game.pass_card(user, card)
+        move = game.pass_card(user, card)
     except ValueError as e:
         return update.message.reply_text(str(e))
     server.save_game(room, game)
-    update.message.reply_text(f"You passed {card}. Your new hand: {hand}")
+    update.message.reply_text(f"You passed {card}. Your new hand: {game.hand(user)}")
     nxt = game.get_current()
-    ctx.bot.send_message(chat, f"{update.effective_user.first_name} passed a card to {ctx.bot.get_chat_member(chat,nxt).user.first_name}.")
-    ctx.bot.send_message(nxt, f"Your hand: {game.hands[nxt]}\nIt's your turn.")
-    if winner:
-        ctx.bot.send_message(chat, f"🎉 {ctx.bot.get_chat_member(chat,winner).user.first_name} won!")
+    outbox.put((chat, f"{update.effective_user.first_name} passed a card to {game.player_names[nxt]}."))
+    outbox.put((nxt, f"Your hand: {game.hand(nxt)}\nIt's your turn."))
+    if move.winner:
+        outbox.put((chat, f"🎉 {game.player_names[move.winner]} won!"))
         server.remove_room(room)
 
 # /stop - end game & room
@@ -146,6 +124,9 @@ dp.add_handler(CommandHandler('begin', handler_begin))
 dp.add_handler(CommandHandler('pass', handler_pass))
 dp.add_handler(handler_end)
 
+# Only command messages are handled, so don't ask Telegram for other update types
 updater.start_webhook(listen='0.0.0.0', port=int(os.environ.get('PORT', 8443)), url_path=TOKEN,
-                      webhook_url=os.environ.get('WEBHOOK_URL')+TOKEN)
+                      webhook_url=os.environ.get('WEBHOOK_URL')+TOKEN,
+                      allowed_updates=[Update.MESSAGE])
 updater.idle()
+server.flush_games()
@@ -1,32 +1,93 @@
 # ─── game.py ───
 import random
+from collections import namedtuple
+import msgspec
+
+class GameState(msgspec.Struct, array_like=True):
+    players: list[int]
+    counts: bytearray
+    previous_card: int = 0
+    current_index: int = 0
+    winner: int | None = None
+    player_names: dict[int, str] = {}
+    game_id: int = 0
+    turn: int = 0
+
+# What changed in a pass: the card the passer picked up (0 on the first
+# pass), the card they passed on, and the winner if the pass won the game
+MoveResult = namedtuple('MoveResult', 'received passed winner')
+
+# Sorted decks (four of each rank) per table size; other sizes are added on first use
+_DECKS = {n: tuple(v for v in range(1, n+1) for _ in range(4)) for n in (4, 5, 6)}
 
 class ParchiDhapGame:
-    def __init__(self, players):
+    __slots__ = ('players', 'player_index', 'player_names', 'n', 'counts', 'previous_card', 'current_index', 'winner',
+                 'game_id', 'turn')
+
+    def __init__(self, players, player_names, seed=None):
         self.players = players[:]           # user_ids list
+        self.player_index = {pid: i for i, pid in enumerate(self.players)}
+        self.player_names = dict(player_names)  # user_id -> first name, cached at /join
         self.n = len(players)
-        deck = []
-        for v in range(1, self.n+1):
-            deck += [v]*4
-        random.shuffle(deck)
-        self.hands = {pid: [deck.pop() for _ in range(4)] for pid in players}
-        self.previous_card = None
+        deck = _DECKS.get(self.n)
+        if deck is None:
+            deck = _DECKS[self.n] = tuple(v for v in range(1, self.n+1) for _ in range(4))
+        # One contiguous n x n count matrix: counts[p*n + c-1] is how many
+        # cards of rank c the player at index p holds
+        self.counts = bytearray(self.n*self.n)
+        rng = random.Random(seed)  # per-game generator; pass a seed to replay a deal
+        for i, c in enumerate(rng.sample(deck, len(deck))):
+            self.counts[i // 4 * self.n + c-1] += 1
+        self.previous_card = 0  # cards are 1..n, so 0 means none passed yet
         self.current_index = 0
         self.winner = None
+        self.game_id = random.getrandbits(63)  # tells this deal apart from earlier games in the room
+        self.turn = 0  # passes made so far
+
+    @classmethod
+    def from_state(cls, state):
+        game = cls.__new__(cls)
+        game.players = state.players
+        game.player_index = {pid: i for i, pid in enumerate(state.players)}
+        game.n = len(state.players)
+        game.counts = state.counts
+        game.previous_card = state.previous_card
+        game.current_index = state.current_index
+        game.winner = state.winner
+        game.player_names = state.player_names
+        game.game_id = state.game_id
+        game.turn = state.turn
+        return game
+
+    def to_state(self):
+        # Snapshot the counts: the state may be encoded on another thread
+        return GameState(self.players, self.counts[:], self.previous_card, self.current_index, self.winner, self.player_names,
+                         self.game_id, self.turn)
 
     def get_current(self): return self.players[self.current_index]
 
+    def hand(self, user_id):
+        base = self.player_index[user_id] * self.n
+        return [c for c, k in enumerate(self.counts[base:base+self.n], 1) for _ in range(k)]
+
     def pass_card(self, user_id, card):
-        if user_id != self.get_current():
-            raise ValueError('Not your turn')
-        hand = self.hands[user_id]
-        if card not in hand:
-            raise ValueError('You do not have that card')
-        hand.remove(card)
-        if self.previous_card is not None:
-            hand.append(self.previous_card)
+        # Hot attributes bound to locals once; only written back at the end
+        idx, n, prev = self.current_index, self.n, self.previous_card
+        counts, base = self.counts, idx * n
+        # One guard on the valid path; work out which check failed only when raising
+        if self.player_index.get(user_id) != idx or not 0 < card <= n or not counts[base+card-1]:
+            raise ValueError('Not your turn' if user_id != self.players[idx] else 'You do not have that card')
+        counts[base+card-1] -= 1
         self.previous_card = card
-        if len(set(hand))==1:
+        # The first player passes before anyone has passed to them, so they
+        # hold 3 cards for the rest of the game and everyone else holds 4. A
+        # hand is all one rank only if the card just picked up completed it.
+        if prev:
+            counts[base+prev-1] += 1
+            if counts[base+prev-1] == (4 if idx else 3):
+                self.winner = user_id
+        elif 3 in counts[base:base+n]:
             self.winner = user_id
-        self.current_index = (self.current_index+1) % self.n
-        return hand, self.winner
+        self.current_index = idx + 1 if idx + 1 < n else 0
+        self.turn += 1
+        return MoveResult(prev, card, self.winner)
@@ -1,6 +1,255 @@
 # ─── server.py ───
+import logging
+import os
 import sqlite3
-import pickle
-from contextlib import closing
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import msgspec
+from game import GameState, ParchiDhapGame
 
-DB = 'parchi_dhap.db'
\ No newline at end of file
+logger = logging.getLogger(__name__)
+
+DB = 'parchi_dhap.db'
+WAL_DIR = 'rooms'
+
+# Hot-path statements, shared so sqlite3's statement cache hits on every call
+_SQL_GET_ROOM = "SELECT room_id FROM rooms WHERE chat_id=?"
+_SQL_CREATE_ROOM = "INSERT OR IGNORE INTO rooms(chat_id) VALUES(?)"
+_SQL_ADD_USER = "INSERT OR IGNORE INTO room_users(room_id,user_id,name) VALUES(?,?,?)"
+_SQL_LIST_USERS = "SELECT user_id, name FROM room_users WHERE room_id=?"
+_SQL_DELETE_ROOM = "DELETE FROM rooms WHERE room_id=?"
+_SQL_SAVE_GAME = ("REPLACE INTO games(room_id,players,names,game_id,turn,current_index,previous_card,winner,counts) "
+                  "VALUES(?,?,?,?,?,?,?,?,?)")
+_SQL_SAVE_TURN = "UPDATE games SET turn=?, current_index=?, previous_card=?, winner=?, counts=? WHERE room_id=?"
+_SQL_LOAD_GAME = ("SELECT players,names,game_id,turn,current_index,previous_card,winner,counts "
+                  "FROM games WHERE room_id=?")
+
+# Shared connections: one read-write, one read-only
+_lock = threading.Lock()
+_conn = sqlite3.connect(DB, check_same_thread=False, isolation_level=None, cached_statements=512)
+_conn.executescript("""
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-20000;
+PRAGMA foreign_keys=ON;
+""")
+
+# Bump SCHEMA_VERSION whenever room_users or games change shape. Those tables
+# only hold lobbies and in-flight games, so older copies are dropped and
+# recreated below rather than migrated row by row.
+SCHEMA_VERSION = 2
+if _conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+    _conn.executescript(f"""
+    DROP TABLE IF EXISTS room_users;
+    DROP TABLE IF EXISTS games;
+    PRAGMA user_version={SCHEMA_VERSION};
+    """)
+    if os.path.isdir(WAL_DIR):
+        for name in os.listdir(WAL_DIR):
+            os.remove(os.path.join(WAL_DIR, name))
+
+# Initialize tables
+_conn.execute("""
+CREATE TABLE IF NOT EXISTS rooms (
+    room_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER UNIQUE
+)""")
+_conn.execute("""
+CREATE TABLE IF NOT EXISTS room_users (
+    room_id INTEGER REFERENCES rooms(room_id) ON DELETE CASCADE,
+    user_id INTEGER,
+    name TEXT,
+    PRIMARY KEY (room_id, user_id)
+)""")
+_conn.execute("""
+CREATE TABLE IF NOT EXISTS games (
+    room_id INTEGER PRIMARY KEY REFERENCES rooms(room_id) ON DELETE CASCADE,
+    players BLOB,
+    names BLOB,
+    game_id INTEGER,
+    turn INTEGER,
+    current_index INTEGER,
+    previous_card INTEGER,
+    winner INTEGER,
+    counts BLOB
+)""")
+
+_ro_lock = threading.Lock()
+_ro_conn = sqlite3.connect(f'file:{DB}?mode=ro', uri=True, check_same_thread=False, isolation_level=None,
+                           cached_statements=512)
+_ro_conn.execute("PRAGMA cache_size=-20000")
+
+# Game writes run on a single writer thread so handlers don't wait on
+# encoding or fsync; one worker keeps every room's writes in order.
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+_write_errors = []  # failures not yet re-raised by flush_games
+
+def _check_write(fut):
+    exc = fut.exception()
+    if exc is not None:
+        logger.error('game write failed', exc_info=exc)
+        _write_errors.append(exc)
+
+def _submit(fn, *args):
+    _writer.submit(fn, *args).add_done_callback(_check_write)
+
+# Room management
+def get_room_by_chat(chat_id):
+    with _ro_lock:
+        row = _ro_conn.execute(_SQL_GET_ROOM, (chat_id,)).fetchone()
+    return row[0] if row else None
+
+def create_room(chat_id):
+    with _lock:
+        _conn.execute(_SQL_CREATE_ROOM, (chat_id,))
+    return get_room_by_chat(chat_id)
+
+def add_user(room_id, user_id, name):
+    with _lock:
+        _conn.execute(_SQL_ADD_USER, (room_id, user_id, name))
+
+def list_users(room_id):
+    with _ro_lock:
+        return dict(_ro_conn.execute(_SQL_LIST_USERS, (room_id,)).fetchall())
+
+def _delete_room(room_id):
+    with _lock:
+        _conn.execute(_SQL_DELETE_ROOM, (room_id,))  # cascades to room_users and games
+    try:
+        os.remove(_wal_path(room_id))
+    except FileNotFoundError:
+        pass
+
+def remove_room(room_id):
+    _game_cache.pop(room_id, None)
+    _dirty.pop(room_id, None)
+    _last_used.pop(room_id, None)
+    # Queued behind any pending game writes for this room
+    _writer.submit(_delete_room, room_id).result()
+
+# Game state persistence: the roster is written once per game, turns only
+# update the scalar columns and the raw count matrix
+Encoder = msgspec.msgpack.Encoder()
+PlayersDecoder = msgspec.msgpack.Decoder(list[int])
+NamesDecoder = msgspec.msgpack.Decoder(dict[int, str])
+TurnDecoder = msgspec.msgpack.Decoder(tuple[int, int, int, int, int | None, bytearray])
+
+# Active games stay in memory. Each turn is appended to the room's WAL file
+# and SQLite gets a snapshot every FLUSH_EVERY turns. Frames carry the game id
+# and turn number, so only frames newer than the snapshot of the same game are
+# replayed (a crash between snapshot and truncate leaves older ones behind).
+FLUSH_EVERY = 8
+# Games untouched for GAME_IDLE_SECONDS are snapshotted and dropped from the
+# cache; a later /pass reloads them from SQLite
+GAME_IDLE_SECONDS = 30 * 60
+_game_cache = {}
+_dirty = {}
+_last_used = {}
+_next_sweep = 0.0
+os.makedirs(WAL_DIR, exist_ok=True)
+
+def _touch(room_id):
+    global _next_sweep
+    now = time.monotonic()
+    _last_used[room_id] = now
+    if now < _next_sweep:
+        return
+    _next_sweep = now + 60
+    for idle_id, used in list(_last_used.items()):
+        if now - used > GAME_IDLE_SECONDS:
+            if idle_id in _dirty:
+                _write_game(idle_id, _game_cache[idle_id])
+            _game_cache.pop(idle_id, None)
+            del _last_used[idle_id]
+
+def _wal_path(room_id):
+    return os.path.join(WAL_DIR, f'{room_id}.wal')
+
+def _append_turn(room_id, state):
+    buf = Encoder.encode((state.game_id, state.turn, state.current_index, state.previous_card, state.winner,
+                          state.counts))
+    # Opened per frame so idle rooms don't pin a file descriptor
+    with open(_wal_path(room_id), 'ab', buffering=0) as f:
+        f.write(struct.pack('>I', len(buf)) + buf)
+
+def _read_wal(room_id, game_id, turn):
+    # Newest complete frame of this game past `turn`; a torn trailing frame is ignored
+    try:
+        with open(_wal_path(room_id), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    latest, pos = None, 0
+    while pos + 4 <= len(data):
+        end = pos + 4 + struct.unpack_from('>I', data, pos)[0]
+        if end > len(data):
+            break
+        frame, pos = TurnDecoder.decode(data[pos+4:end]), end
+        if frame[0] == game_id and frame[1] > turn:
+            latest, turn = frame, frame[1]
+    return latest
+
+def _truncate_wal(room_id):
+    try:
+        os.truncate(_wal_path(room_id), 0)
+    except FileNotFoundError:
+        pass
+
+def _store_game(room_id, state):
+    row = (room_id, Encoder.encode(state.players), Encoder.encode(state.player_names), state.game_id, state.turn,
+           state.current_index, state.previous_card, state.winner, state.counts)
+    with _lock:
+        _conn.execute(_SQL_SAVE_GAME, row)
+    _truncate_wal(room_id)
+
+def _store_turn(room_id, state):
+    row = (state.turn, state.current_index, state.previous_card, state.winner, state.counts, room_id)
+    with _lock:
+        _conn.execute(_SQL_SAVE_TURN, row)
+    _truncate_wal(room_id)
+
+def _write_game(room_id, game, store=_store_turn):
+    _dirty.pop(room_id, None)
+    _submit(store, room_id, game.to_state())
+
+def save_game(room_id, game):
+    _touch(room_id)
+    if _game_cache.get(room_id) is not game:
+        _game_cache[room_id] = game
+        return _write_game(room_id, game, _store_game)
+    pending = _dirty.get(room_id, 0) + 1
+    if pending >= FLUSH_EVERY:
+        return _write_game(room_id, game)
+    _dirty[room_id] = pending
+    _submit(_append_turn, room_id, game.to_state())
+
+def flush_games():
+    for room_id in list(_dirty):
+        _write_game(room_id, _game_cache[room_id])
+    _writer.submit(lambda: None).result()  # wait for queued writes
+    if _write_errors:
+        exc = _write_errors[0]
+        _write_errors.clear()
+        raise exc
+
+def load_game(room_id):
+    _touch(room_id)
+    game = _game_cache.get(room_id)
+    if game is not None:
+        return game
+    with _ro_lock:
+        row = _ro_conn.execute(_SQL_LOAD_GAME, (room_id,)).fetchone()
+    if not row:
+        return None
+    players = PlayersDecoder.decode(row[0])
+    game_id, turn, current_index, previous_card, winner, counts = row[2:7] + (bytearray(row[7]),)
+    frame = _read_wal(room_id, game_id, turn)
+    if frame:
+        _, turn, current_index, previous_card, winner, counts = frame
+    state = GameState(players, counts, previous_card, current_index, winner,
+                      NamesDecoder.decode(row[1]), game_id, turn)
+    game = _game_cache[room_id] = ParchiDhapGame.from_state(state)
+    return game